@@ -14,6 +14,7 @@ from .plugins.buffer import (  # noqa: E402, F401
     TextStreamAtCommand,
 )
 from .plugins.openai import Openai  # noqa: E402, F401
+from .plugins.openai_network_client import close_pooled_connections  # noqa: E402
 from .plugins.openai_panel import OpenaiPanelCommand  # noqa: E402, F401
 from .plugins.output_panel import SharedOutputPanelListener  # noqa: E402, F401
 from .plugins.phantom_streamer import PhantomStreamer  # noqa: E402, F401
@@ -25,3 +26,7 @@ from .plugins.stop_worker_execution import (  # noqa: E402
 from .plugins.worker_running_context import (  # noqa: E402,
     OpenaiWorkerRunningContext,  # noqa: F401
 )
+
+
+def plugin_unloaded():
+    close_pooled_connections()
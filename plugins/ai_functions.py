@@ -1,5 +1,7 @@
 from enum import Enum
 
+from .json_utility import dumps
+
 
 class Function(str, Enum):
     replace_text_with_another_text = 'replace_text_with_another_text'
@@ -118,9 +120,13 @@ GET_WORKING_DIRECTORY_CONTENT = {
 }
 
 
-FUNCTION_DATA = [
-    REPLACE_TEXT_WITH_ANOTHER_TEXT,
-    READ_REGION_CONTENT,
-    GET_WORKING_DIRECTORY_CONTENT,
-    REPLACE_TEXT_FOR_WHOLE_FILE,
-]
+# Tools definition never changes, so it's serialized once and spliced into every payload as is.
+# Being bytes, the shared definition can't be mutated by anyone down the line.
+FUNCTION_DATA_JSON: bytes = dumps(
+    [
+        REPLACE_TEXT_WITH_ANOTHER_TEXT,
+        READ_REGION_CONTENT,
+        GET_WORKING_DIRECTORY_CONTENT,
+        REPLACE_TEXT_FOR_WHOLE_FILE,
+    ]
+)
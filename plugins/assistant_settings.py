@@ -56,6 +56,8 @@ class AssistantSettings:
     parallel_tool_calls: bool | None
     stream: bool
     advertisement: bool
+    history_limit: int | None
+    prompt_cache_key: str | None
 
 
 DEFAULT_ASSISTANT_SETTINGS: Dict[str, Any] = {
@@ -73,6 +75,8 @@ DEFAULT_ASSISTANT_SETTINGS: Dict[str, Any] = {
     'parallel_tool_calls': None,
     'stream': True,
     'advertisement': True,
+    'history_limit': None,
+    'prompt_cache_key': None,
 }
 
 
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import logging
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List, Tuple
 
 from sublime import Edit, Region, Sheet, View
 from sublime_plugin import TextCommand
@@ -9,6 +9,9 @@ from sublime_types import Point
 
 logger = logging.getLogger(__name__)
 
+# Wrapped content of the sheets passed last time, keyed by view id
+_WRAPPED_SHEETS_CACHE: Dict[int, Tuple[Tuple[Any, ...], Tuple[str, str | None, str]]] = {}
+
 
 class BufferContentManager:
     def __init__(self, view: View) -> None:
@@ -28,17 +31,18 @@ class BufferContentManager:
 
     @classmethod
     def wrap_content_with_scope(cls, scope_name: str, content: str) -> str:
-        logger.debug(f'scope_name {scope_name}')
+        logger.debug('scope_name %s', scope_name)
         if scope_name.strip().lower() in ['markdown', 'multimarkdown', 'plain']:
             wrapped_content = content
         else:
             wrapped_content = f'```{scope_name}\n{content}\n```'
-        logger.debug(f'wrapped_content {wrapped_content}')
+        logger.debug('wrapped_content %s', wrapped_content)
         return wrapped_content
 
     @staticmethod
     def wrap_sheet_contents_with_scope(sheets: List[Sheet] | None) -> List[Tuple[str, str | None, str]]:
         wrapped_selection: List[Tuple[str, str | None, str]] = []
+        cache: Dict[int, Tuple[Tuple[Any, ...], Tuple[str, str | None, str]]] = {}
 
         if sheets:
             for sheet in sheets:
@@ -46,16 +50,28 @@ class BufferContentManager:
                 if not view:
                     continue  # If for some reason the sheet cannot be converted to a view, skip.
 
-                scope_region = view.scope_name(0)  # Assuming you want the scope at the start of the document
-                scope_name = scope_region.split(' ')[0].split('.')[-1]
-
                 file_path = view.file_name()
-                content = view.substr(Region(0, view.size()))
-                content = BufferContentManager.wrap_content_with_scope(scope_name, content)
-
-                wrapped_content = f'Path: `{file_path}`\n\n' + content
-                wrapped_selection.append((scope_name, file_path, wrapped_content))
-
+                # Reusing the previous result while the buffer, its path and syntax stay the same
+                key = (view.change_count(), file_path, view.settings().get('syntax'))
+                cached = _WRAPPED_SHEETS_CACHE.get(view.id())
+                if cached and cached[0] == key:
+                    wrapped_item = cached[1]
+                else:
+                    scope_region = view.scope_name(0)  # scope at the start of the document
+                    scope_name = scope_region.split(' ')[0].split('.')[-1]
+
+                    content = view.substr(Region(0, view.size()))
+                    content = BufferContentManager.wrap_content_with_scope(scope_name, content)
+
+                    wrapped_content = f'Path: `{file_path}`\n\n' + content
+                    wrapped_item = (scope_name, file_path, wrapped_content)
+
+                cache[view.id()] = (key, wrapped_item)
+                wrapped_selection.append(wrapped_item)
+
+        # Keeping only the sheets from this call, so contents of closed views don't linger in memory
+        _WRAPPED_SHEETS_CACHE.clear()
+        _WRAPPED_SHEETS_CACHE.update(cache)
         return wrapped_selection
 
 
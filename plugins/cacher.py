@@ -4,7 +4,7 @@ import json
 import logging
 import os
 from json.decoder import JSONDecodeError
-from typing import Any, Dict, Iterator, List, Tuple
+from typing import Any, Dict, List, NamedTuple, Tuple
 
 import sublime
 
@@ -13,6 +13,27 @@ from . import jl_utility as jl
 logger = logging.getLogger(__name__)
 
 
+class TokensSnapshot(NamedTuple):
+    prompt_tokens: int
+    completion_tokens: int
+    history_length: int
+
+
+HistoryCache = Tuple[Tuple[int, int], List[Dict[str, str]]]
+TokensCountCache = Tuple[Tuple[int, int], Dict[str, int]]
+
+# History and counters kept in memory along with the stat of the file they're read from,
+# so they're reread only if the file got changed by someone else. They're keyed by file path
+# to outlive `Cacher` instances, as a new one is made for every request.
+_HISTORY_CACHES: Dict[str, HistoryCache] = {}
+_TOKENS_COUNT_CACHES: Dict[str, TokensCountCache] = {}
+
+
+def _stat_key(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
 class Cacher:
     def __init__(self, name: str | None = None) -> None:
         cache_dir = sublime.cache_path()
@@ -37,24 +58,77 @@ class Cacher:
         for item in [self.history_file, self.current_model_file, self.tokens_count_file]:
             self.check_and_create(item)
 
+    @property
+    def history_cache(self) -> HistoryCache | None:
+        return _HISTORY_CACHES.get(self.history_file)
+
+    @history_cache.setter
+    def history_cache(self, value: HistoryCache | None):
+        if value is None:
+            _HISTORY_CACHES.pop(self.history_file, None)
+        else:
+            _HISTORY_CACHES[self.history_file] = value
+
+    @property
+    def tokens_count_cache(self) -> TokensCountCache | None:
+        return _TOKENS_COUNT_CACHES.get(self.tokens_count_file)
+
+    @tokens_count_cache.setter
+    def tokens_count_cache(self, value: TokensCountCache | None):
+        if value is None:
+            _TOKENS_COUNT_CACHES.pop(self.tokens_count_file, None)
+        else:
+            _TOKENS_COUNT_CACHES[self.tokens_count_file] = value
+
     def check_and_create(self, path: str):
         if not os.path.isfile(path):
             open(path, 'w').close()
 
     def len(self) -> int:
-        length = len(self.read_all()) // 2
-        logger.debug(f'history length: {length}')
+        length = self.history_lines_count_() // 2
+        logger.debug('history length: %s', length)
         return length
 
+    def history_lines_count_(self) -> int:
+        return len(self.load_history_())
+
+    def load_history_(self) -> List[Dict[str, str]]:
+        """Returns history lines as they're stored on disk, placeholders aren't expanded.
+
+        The list is shared with the cache, so it must not be mutated by a caller.
+        """
+        self.check_and_create(self.history_file)
+        key = _stat_key(self.history_file)
+        if self.history_cache and self.history_cache[0] == key:
+            return self.history_cache[1]
+
+        lines: List[Dict[str, str]] = list(jl.reader(self.history_file))
+        self.history_cache = (key, lines)
+        return lines
+
+    def is_history_cache_valid_(self) -> bool:
+        return self.history_cache is not None and self.history_cache[0] == _stat_key(self.history_file)
+
+    def load_tokens_count_(self) -> Dict[str, int]:
+        self.check_and_create(self.tokens_count_file)
+        key = _stat_key(self.tokens_count_file)
+        if self.tokens_count_cache and self.tokens_count_cache[0] == key:
+            return self.tokens_count_cache[1]
+
+        with open(self.tokens_count_file, 'r') as file:
+            try:
+                data: Dict[str, int] = json.load(file)
+            except JSONDecodeError:
+                data = {}
+        self.tokens_count_cache = (key, data)
+        return data
+
     def append_tokens_count(self, data: Dict[str, int]):
-        try:
-            with open(self.tokens_count_file, 'r') as file:
-                existing_data: Dict[str, int] = json.load(file)
-        except (FileNotFoundError, JSONDecodeError):
-            existing_data = {
-                'prompt_tokens': 0,
-                'completion_tokens': 0,
-            }
+        existing_data = {
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            **self.load_tokens_count_(),
+        }
 
         for key, value in data.items():
             if key in existing_data:
@@ -64,10 +138,17 @@ class Cacher:
 
         with open(self.tokens_count_file, 'w') as file:
             json.dump(existing_data, file)
+        self.tokens_count_cache = (_stat_key(self.tokens_count_file), existing_data)
+
+    def snapshot(self) -> TokensSnapshot:
+        """Reads tokens count and history length in one go."""
+        req_tok, out_tok = self.read_tokens_count()
+        return TokensSnapshot(req_tok, out_tok, self.len())
 
     def reset_tokens_count(self):
         with open(self.tokens_count_file, 'w') as _:
             pass  # Truncate the file by opening it in 'w' mode and doing nothing
+        self.tokens_count_cache = None
 
     @staticmethod
     def read_file_from_project(file_path: str) -> str:
@@ -76,14 +157,8 @@ class Cacher:
             return content
 
     def read_tokens_count(self) -> Tuple[int, int]:
-        self.check_and_create(self.tokens_count_file)
-        with open(self.tokens_count_file, 'r') as file:
-            try:
-                data: Dict[str, int] | None = json.load(file)
-                tokens = (data['prompt_tokens'], data['completion_tokens'])
-            except JSONDecodeError:
-                return (0, 0)
-        return tokens
+        data = self.load_tokens_count_()
+        return (data.get('prompt_tokens', 0), data.get('completion_tokens', 0))
 
     def save_model(self, data: Dict[str, Any]):
         with open(self.current_model_file, 'w') as file:
@@ -105,7 +180,7 @@ class Cacher:
     def expand_placeholders(line: Dict[str, str]) -> Dict[str, str]:
         if {'file_path', 'scope_name'}.issubset(line.keys()) and line['file_path']:
             file_path = line['file_path']
-            logger.debug(f'file_path {file_path}')
+            logger.debug('file_path %s', file_path)
             scope = line['scope_name']
             file_content = Cacher.read_file_from_project(file_path)
             content = f'Path: `{file_path}`\n\n'
@@ -116,30 +191,33 @@ class Cacher:
         return line
 
     def read_all(self) -> List[Dict[str, str]]:
-        self.check_and_create(self.history_file)
-        json_objects: List[Dict[str, str]] = []
-        reader: Iterator[Dict[str, str]] = jl.reader(self.history_file)
-        for json_object in reader:
-            expanded_json = Cacher.expand_placeholders(json_object)
-            json_objects.append(expanded_json)
-
-        return json_objects
+        # Placeholders are expanded on every read, as the files they point to might have been changed
+        return [Cacher.expand_placeholders(line.copy()) for line in self.load_history_()]
 
     def append_to_cache(self, cache_lines: List[Dict[str, str]]):
         # Create a new JSON Lines writer for output.jl
+        self.check_and_create(self.history_file)
+        is_cache_valid = self.is_history_cache_valid_()
+        written_lines: List[Dict[str, str]] = []
         writer = jl.writer(self.history_file)
         next(writer)
         for line in cache_lines:
-            if {'content', 'file_path', 'scope_name'}.issubset(line.keys()):
-                if line['file_path']:
-                    copy_of_line = line.copy()
-                    del copy_of_line['content']
-                    writer.send(copy_of_line)
-                    continue
-            writer.send(line)
+            copy_of_line = line.copy()
+            if {'content', 'file_path', 'scope_name'}.issubset(line.keys()) and line['file_path']:
+                del copy_of_line['content']
+            writer.send(copy_of_line)
+            written_lines.append(copy_of_line)
+        writer.close()
+
+        self.history_cache = (
+            (_stat_key(self.history_file), [*self.history_cache[1], *written_lines])  # type: ignore
+            if is_cache_valid
+            else None
+        )
 
     def drop_first(self, number=4):
         self.check_and_create(self.history_file)
+        is_cache_valid = self.is_history_cache_valid_()
         # Read all lines from the JSON Lines file
         with open(self.history_file, 'r') as file:
             lines = file.readlines()
@@ -150,11 +228,19 @@ class Cacher:
         # Write the remaining lines back to the cache file
         with open(self.history_file, 'w') as file:
             file.writelines(lines)
+        self.history_cache = (
+            (_stat_key(self.history_file), self.history_cache[1][number:])  # type: ignore
+            if is_cache_valid
+            else None
+        )
 
     def drop_all(self):
         with open(self.history_file, 'w') as _:
             pass  # Truncate the file by opening it in 'w' mode and doing nothing
+        self.history_cache = (_stat_key(self.history_file), [])
 
     def delete_all_caches_(self):
         for item in [self.history_file, self.current_model_file, self.tokens_count_file]:
             os.remove(item)
+        self.history_cache = None
+        self.tokens_count_cache = None
@@ -1,169 +1,175 @@
 from __future__ import annotations
 
 import logging
-from json import dumps
-from typing import Dict, List
+from typing import Callable, Dict, List, Tuple, Union
 
 from sublime import Region, Window
 
 from .assistant_settings import ToolCall
-from .cacher import Cacher
 from .errors.OpenAIException import FunctionCallFailedException
 from .messages import MessageCreator
 from .project_structure import build_folder_structure
 from .support_types import JSONType
 from .ai_functions import Function
+from .json_utility import dumps
 
 logger = logging.getLogger(__name__)
 
+# `view.find` takes a regex, so text to search has to be escaped. Backslash is escaped
+# within the same pass, so escapes added for the other characters aren't doubled.
+REGEX_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in '()[]{}|"\\.*+?^$'})
+
+ToolArguments = Dict[str, Union[str, int, bool, Dict[str, int]]]
+
 
 class FunctionHandler:
     @staticmethod
-    def perform_function(cacher: Cacher, window: Window, tool: ToolCall) -> List[Dict[str, str]]:
-        logger.debug(f'executing: {tool.function.name}')
-        if tool.function.name == Function.replace_text_with_another_text.value:
-            path = tool.function.arguments.get('file_path')
-            old_content = tool.function.arguments.get('old_content')
-            new_content = tool.function.arguments.get('new_content')
-
-            if (
-                path
-                and isinstance(path, str)
-                and old_content
-                and isinstance(old_content, str)
-                and new_content
-                and isinstance(new_content, str)
-            ):
-                view = window.find_open_file(path)
-                if view:
-                    escaped_string = (
-                        old_content.replace('(', r'\(')
-                        .replace(')', r'\)')
-                        .replace('[', r'\[')
-                        .replace(']', r'\]')
-                        .replace('{', r'\{')
-                        .replace('}', r'\}')
-                        .replace('|', r'\|')
-                        .replace('"', r'\"')
-                        .replace('\\', r'\\\\')
-                    )
-                    region = view.find(pattern=escaped_string, start_pt=0)
-                    logger.debug(f'region {region}')
-                    serializable_region = {
-                        'a': region.begin(),
-                        'b': region.end(),
-                    }
-                    if (
-                        region.begin() == region.end() == -1 or region.begin() == region.end() == 0
-                    ):  # means search found nothing
-                        raise FunctionCallFailedException(f'Text not found: {old_content}')
-                    else:
-                        view.run_command(
-                            'replace_region',
-                            {'region': serializable_region, 'text': new_content},
-                        )
-                        return MessageCreator.create_message(
-                            cacher, command=dumps(serializable_region), tool_call_id=tool.id
-                        )
-                else:
-                    raise FunctionCallFailedException(f'File under path not found: {path}')
-            else:
-                raise FunctionCallFailedException(
-                    f'Wrong attributes passed: {path}, {old_content}, {new_content}'
-                )
-        elif tool.function.name == Function.replace_text_for_whole_file.value:
-            path = tool.function.arguments.get('file_path')
-            create = tool.function.arguments.get('create')
-            content = tool.function.arguments.get('content')
-            if path and isinstance(path, str) and content and isinstance(content, str):
-                if isinstance(create, bool):
-                    window.open_file(path)
-                view = window.find_open_file(path)
-                if view:
-                    region = Region(0, len(view))
-                    view.run_command(
-                        'replace_region',
-                        {'region': {'a': region.begin(), 'b': region.end()}, 'text': content},
-                    )
-                    text = view.substr(region)
-                    return MessageCreator.create_message(
-                        cacher, command=dumps({'result': text}), tool_call_id=tool.id
-                    )
-                else:
-                    raise FunctionCallFailedException(f'File under path not found: {path}')
-            else:
-                raise FunctionCallFailedException(f'Wrong attributes passed: {path}, {content}')
-
-        elif tool.function.name == Function.read_region_content.value:
-            path = tool.function.arguments.get('file_path')
-            region = tool.function.arguments.get('region')
-            if path and isinstance(path, str) and region and isinstance(region, Dict):
-                view = window.find_open_file(path)
-                if view:
-                    a_reg: int = region.get('a') if region.get('a') != -1 else 0  # type: ignore
-                    b_reg = region.get('b') if region.get('b') != -1 else len(view)
-                    region_ = Region(a=a_reg, b=b_reg)
-                    text = view.substr(region_)
-                    return MessageCreator.create_message(
-                        cacher, command=dumps({'content': f'{text}'}), tool_call_id=tool.id
-                    )
-                else:
-                    raise FunctionCallFailedException(f'File under path not found: {path}')
-            else:
-                raise FunctionCallFailedException(f'Wrong attributes passed: {path}, {region}')
-        elif tool.function.name == Function.get_working_directory_content.value:
-            path = tool.function.arguments.get('directory_path')
-            if path and isinstance(path, str):
-                folder_structure = build_folder_structure(path)
-
-                return MessageCreator.create_message(
-                    cacher, command=dumps({'content': f'{folder_structure}'}), tool_call_id=tool.id
-                )
-            else:
-                raise FunctionCallFailedException(f'Wrong attributes passed: {path}')
-        else:
+    def perform_function(window: Window, tool: ToolCall) -> Dict[str, str]:
+        logger.debug('executing: %s', tool.function.name)
+        handler = TOOL_HANDLERS.get(tool.function.name)
+        if not handler:
             raise FunctionCallFailedException(f"Called function doen't exists: {tool.function.name}")
 
+        result = handler(window, tool.function.arguments)
+        return MessageCreator.create_tool_message(dumps(result).decode('utf-8'), tool.id)
+
+    @staticmethod
+    def replace_text_with_another_text(window: Window, arguments: ToolArguments) -> JSONType:
+        path = arguments.get('file_path')
+        old_content = arguments.get('old_content')
+        new_content = arguments.get('new_content')
+
+        if not (
+            path
+            and isinstance(path, str)
+            and old_content
+            and isinstance(old_content, str)
+            and new_content
+            and isinstance(new_content, str)
+        ):
+            raise FunctionCallFailedException(
+                f'Wrong attributes passed: {path}, {old_content}, {new_content}'
+            )
+
+        view = window.find_open_file(path)
+        if not view:
+            raise FunctionCallFailedException(f'File under path not found: {path}')
+
+        escaped_string = old_content.translate(REGEX_ESCAPE_TABLE)
+        region = view.find(pattern=escaped_string, start_pt=0)
+        logger.debug('region %s', region)
+        serializable_region = {
+            'a': region.begin(),
+            'b': region.end(),
+        }
+        if region.begin() == region.end() == -1 or region.begin() == region.end() == 0:
+            # means search found nothing
+            raise FunctionCallFailedException(f'Text not found: {old_content}')
+
+        view.run_command(
+            'replace_region',
+            {'region': serializable_region, 'text': new_content},
+        )
+        return serializable_region
+
+    @staticmethod
+    def replace_text_for_whole_file(window: Window, arguments: ToolArguments) -> JSONType:
+        path = arguments.get('file_path')
+        create = arguments.get('create')
+        content = arguments.get('content')
+        if not (path and isinstance(path, str) and content and isinstance(content, str)):
+            raise FunctionCallFailedException(f'Wrong attributes passed: {path}, {content}')
+
+        if isinstance(create, bool):
+            window.open_file(path)
+        view = window.find_open_file(path)
+        if not view:
+            raise FunctionCallFailedException(f'File under path not found: {path}')
+
+        region = Region(0, len(view))
+        view.run_command(
+            'replace_region',
+            {'region': {'a': region.begin(), 'b': region.end()}, 'text': content},
+        )
+        text = view.substr(region)
+        return {'result': text}
+
+    @staticmethod
+    def read_region_content(window: Window, arguments: ToolArguments) -> JSONType:
+        path = arguments.get('file_path')
+        region = arguments.get('region')
+        if not (path and isinstance(path, str) and region and isinstance(region, Dict)):
+            raise FunctionCallFailedException(f'Wrong attributes passed: {path}, {region}')
+
+        view = window.find_open_file(path)
+        if not view:
+            raise FunctionCallFailedException(f'File under path not found: {path}')
+
+        a_reg: int = region.get('a') if region.get('a') != -1 else 0  # type: ignore
+        b_reg = region.get('b') if region.get('b') != -1 else len(view)
+        region_ = Region(a=a_reg, b=b_reg)
+        text = view.substr(region_)
+        return {'content': f'{text}'}
+
+    @staticmethod
+    def get_working_directory_content(window: Window, arguments: ToolArguments) -> JSONType:
+        path = arguments.get('directory_path')
+        if not (path and isinstance(path, str)):
+            raise FunctionCallFailedException(f'Wrong attributes passed: {path}')
+
+        folder_structure = build_folder_structure(path)
+        return {'content': f'{folder_structure}'}
+
     @staticmethod
     def append_non_null(original: JSONType, append: JSONType) -> JSONType:
         """
-        Recursively processes the object, returning only non-null fields.
+        Merges a streamed delta into the original object in place, skipping null fields.
+
+        Strings get concatenated, list items are matched by their `index` field,
+        the rest of scalars keep their first value (e.g. tool call `index` itself).
         """
-        if isinstance(original, int) and isinstance(append, int):
-            # logger.debug(f'original: int `{original}`, append: int `{append}`')
-            original += append
-            return original
-
-        elif isinstance(original, str) and isinstance(append, str):
-            # logger.debug(f'original: str `{original}`, append: str `{append}`')
-            original += append
-            return original
-
-        elif isinstance(original, dict) and isinstance(append, dict):
-            # logger.debug(f'original: dict `{original}`, append: dict `{append}`')
-            for key, value in append.items():
-                if value is not None:
-                    if key in original:
-                        original[key] = FunctionHandler.append_non_null(original[key], value)
+        if type(original) is str and type(append) is str:
+            return original + append  # type: ignore
+
+        stack: List[Tuple[JSONType, JSONType]] = [(original, append)]
+        while stack:
+            destination, delta = stack.pop()
+            if type(destination) is dict and type(delta) is dict:
+                for key, value in delta.items():  # type: ignore
+                    if value is None:
+                        continue
+                    if key not in destination:
+                        destination[key] = value  # type: ignore
+                        continue
+                    current = destination[key]  # type: ignore
+                    if type(current) is str and type(value) is str:
+                        destination[key] = current + value  # type: ignore
+                    elif type(current) in (dict, list):
+                        stack.append((current, value))
+
+            elif type(destination) is list and type(delta) is list:
+                for item in delta:  # type: ignore
+                    if type(item) is not dict:
+                        continue
+                    match = next(
+                        (
+                            entry
+                            for entry in destination  # type: ignore
+                            if type(entry) is dict and entry.get('index') == item.get('index')
+                        ),
+                        None,
+                    )
+                    if match is None:
+                        destination.append(item)  # type: ignore
                     else:
-                        original[key] = value
-            return original
-
-        elif isinstance(append, list) and isinstance(original, list):
-            # logger.debug(f'original: list `{original}`, append: list `{append}`')
-            # Append non-null values from append to the original list
-            for index, item in enumerate(append):
-                if (
-                    isinstance(original, list)
-                    and isinstance(original[index], dict)
-                    and isinstance(item, dict)
-                ):
-                    if original[index].get('index') == item['index']:
-                        FunctionHandler.append_non_null(original[index], item)
-                        return original
-                if isinstance(item, dict):
-                    original.append(item)
-            return original
-
-        # If the object is neither a dictionary nor a list, return it directly
+                        stack.append((match, item))
+
         return original
+
+
+TOOL_HANDLERS: Dict[str, Callable[[Window, ToolArguments], JSONType]] = {
+    Function.replace_text_with_another_text.value: FunctionHandler.replace_text_with_another_text,
+    Function.replace_text_for_whole_file.value: FunctionHandler.replace_text_for_whole_file,
+    Function.read_region_content.value: FunctionHandler.read_region_content,
+    Function.get_working_directory_content.value: FunctionHandler.get_working_directory_content,
+}
@@ -0,0 +1,20 @@
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, it isn't available in every Sublime Text setup
+    orjson = None
+
+
+if orjson:
+    dumps = orjson.dumps
+    loads = orjson.loads
+else:
+
+    def dumps(obj: Any) -> bytes:  # type: ignore
+        # Matching orjson output: no padding after separators and no escaping of non ASCII text
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def loads(data: Union[bytes, str]) -> Any:  # type: ignore
+        return json.loads(data)
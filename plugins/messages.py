@@ -8,6 +8,8 @@ from .cacher import Cacher
 
 logger = logging.getLogger(__name__)
 
+IMAGE_ENCODING_BLOCK_SIZE = 57 * 1024
+
 
 class MessageCreator:
     @classmethod
@@ -32,25 +34,29 @@ class MessageCreator:
                 for scope, file_path, text in selected_text  # Iterates over provided non-None selected_text
             ]
 
-            logger.debug(['content' in message for message in new_messages])
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(['content' in message for message in new_messages])
             messages.extend(new_messages)
 
         if command:
             if tool_call_id:
-                messages.append(
-                    {
-                        'role': 'tool',
-                        'content': command,
-                        'tool_call_id': tool_call_id,
-                        'name': 'OpenAI_completion',
-                    }
-                )
+                messages.append(cls.create_tool_message(command, tool_call_id))
             else:
                 messages.append({'role': 'user', 'content': command, 'name': 'OpenAI_completion'})
 
-        logger.debug(['content' in message for message in messages])
+        if logger.isEnabledFor(logging.DEBUG):  # walks over the whole history
+            logger.debug(['content' in message for message in messages])
         return messages
 
+    @classmethod
+    def create_tool_message(cls, command: str, tool_call_id: str) -> Dict[str, str]:
+        return {
+            'role': 'tool',
+            'content': command,
+            'tool_call_id': tool_call_id,
+            'name': 'OpenAI_completion',
+        }
+
     @classmethod
     def create_image_message(
         cls, cacher: Cacher, image_url: str | None, command: str | None
@@ -66,11 +72,11 @@ class MessageCreator:
             for image_url in image_urls:
                 image_url = image_url.strip()
                 if image_url:  # Only handle non-empty lines
-                    base64_image = MessageCreator.encode_image(image_url)
+                    mime_type, base64_image = MessageCreator.encode_image(image_url)
                     image_data_list.append(
                         {
                             'type': 'image_url',
-                            'image_url': {'url': f'data:image/jpeg;base64,{base64_image}'},
+                            'image_url': {'url': f'data:{mime_type};base64,{base64_image}'},
                         }
                     )
 
@@ -99,14 +105,34 @@ class MessageCreator:
         return messages
 
     @classmethod
-    def encode_image(cls, image_path: str) -> str:
+    def encode_image(cls, image_path: str) -> Tuple[str, str]:
+        """Returns MIME type of the image along with its base64 encoded content."""
+        # Encoding by blocks keeps only the base64 output in memory instead of both raw and encoded data,
+        # block size is a multiple of 3 so no padding appears in between blocks.
+        encoded = bytearray()
+        mime_type = 'image/jpeg'
         with open(image_path, 'rb') as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+            for block in iter(lambda: image_file.read(IMAGE_ENCODING_BLOCK_SIZE), b''):
+                if not encoded:
+                    mime_type = cls.detect_image_mime_type(block)
+                encoded += base64.b64encode(block)
+        return mime_type, encoded.decode('ascii')
+
+    @classmethod
+    def detect_image_mime_type(cls, header: bytes) -> str:
+        """Guesses image MIME type by its magic bytes, JPEG is the fallback."""
+        if header.startswith(b'\x89PNG'):
+            return 'image/png'
+        if header.startswith(b'GIF8'):
+            return 'image/gif'
+        if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+            return 'image/webp'
+        return 'image/jpeg'
 
     @classmethod
     def calculate_completion_tokens(cls, responses: List[Dict[str, str]]) -> int:
-        total_tokens = 0
-        for response in responses:
-            if response['content'] and response['role'] == 'assistant':
-                total_tokens += int(len(response['content']) / 4)
-        return total_tokens
+        return sum(
+            len(response['content']) >> 2
+            for response in responses
+            if response.get('role') == 'assistant' and response.get('content')
+        )
@@ -36,8 +36,8 @@ class CommonMethods:
         logger.debug('Region: %s', region)
         build_input = kwargs.pop('build_output', False)
         lsp_diagnostics = kwargs.pop('lsp_diagnostics', False)
-        logger.debug(f'build_input {build_input}')
-        logger.debug(f'lsp_diagnostics {lsp_diagnostics}')
+        logger.debug('build_input %s', build_input)
+        logger.debug('lsp_diagnostics %s', lsp_diagnostics)
         if lsp_diagnostics:
             text = CommonMethods.get_build_output_lines('diagnostics', -1)
         elif build_input and settings:
@@ -115,7 +115,7 @@ class CommonMethods:
 
     @classmethod
     def save_input(cls, user_input: str, window: Window):
-        logger.debug(f'user_input: {user_input}')
+        logger.debug('user_input: %s', user_input)
         window.settings().set('OPENAI_INPUT_TMP_STORAGE', user_input)
 
     @classmethod
@@ -1,24 +1,167 @@
 from __future__ import annotations
 
-import json
 import logging
-from base64 import b64encode
-from http.client import HTTPConnection, HTTPResponse, HTTPSConnection
-from typing import Any, Dict, List
+from functools import lru_cache
+from http.client import HTTPConnection, HTTPResponse, HTTPSConnection, RemoteDisconnected
+from socket import socket
+from threading import Lock
+from typing import Any, Dict, List, NamedTuple, Tuple, Type
 from urllib.parse import urlparse
 
 import sublime
 
-from .ai_functions import FUNCTION_DATA
+from .ai_functions import FUNCTION_DATA_JSON
 from .assistant_settings import AssistantSettings
 from .cacher import Cacher
 from .errors.OpenAIException import ContextLengthExceededException, UnknownException
+from .json_utility import dumps, loads
 
 logger = logging.getLogger(__name__)
 
+ADVERTISEMENT_PROMPT = (
+    '\nEncourage users to consider donating through a provided link in a friendly,'
+    ' respectful, and tactful manner. Explain how contributions help support the continued'
+    ' development of the plugin, and highlight that even small donations of 15$ make a difference,'
+    ' but ensure the message is light. Include a clear call-to-action but avoid'
+    ' pressuring the user. Always express gratitude. Format the donation link nicely:'
+    ' https://github.com/sponsors/yaroslavyaroslav'
+)
+
+
+class ConnectionParams(NamedTuple):
+    headers: Dict[str, bytes]
+    path: str
+    connection_cls: Type[HTTPConnection]
+    host: str
+    proxy_headers: Dict[str, str]
+    proxy_address: str | None
+    proxy_port: int | None
+
+
+@lru_cache(maxsize=8)
+def _build_conn_params(
+    token: str | None, url: str, proxy_key: Tuple[Any, Any, Any, Any] | None
+) -> ConnectionParams:
+    """Everything the connection needs that doesn't change until the settings do.
+
+    Results are shared between clients, so they must be treated as read only.
+    """
+    # Values are encoded upfront the same way http.client does it, so it sends them as is.
+    headers = {
+        'Content-Type': b'application/json',
+        'Authorization': b'Bearer ' + str(token).encode('latin-1'),
+        'cache-control': b'no-cache',
+    }
+
+    parsed_url = urlparse(url)
+    path = parsed_url.path if parsed_url.path.strip('/') else '/v1/chat/completions'
+    connection_cls = HTTPSConnection if parsed_url.scheme == 'https' else HTTPConnection
+
+    proxy_headers: Dict[str, str] = {}
+    address, port = None, None
+    if proxy_key:
+        from base64 import b64encode
+
+        address, port, proxy_username, proxy_password = proxy_key
+        proxy_auth = b64encode(bytes(f'{proxy_username}:{proxy_password}', 'utf-8')).strip().decode('ascii')
+        if len(proxy_auth) > 0:
+            proxy_headers = {'Proxy-Authorization': f'Basic {proxy_auth}'}
+
+    return ConnectionParams(
+        headers=headers,
+        path=path,
+        connection_cls=connection_cls,
+        host=parsed_url.netloc,
+        proxy_headers=proxy_headers,
+        proxy_address=address,
+        proxy_port=port,
+    )
+
+
+RESPONSE_BUFFER_SIZE = 64 * 1024
+
+
+class BufferedHTTPResponse(HTTPResponse):
+    """HTTPResponse that reads the socket through a larger buffer.
+
+    Makes both headers parsing and SSE lines iteration go with fewer `recv` calls.
+    """
+
+    def __init__(self, sock: socket, *args, **kwargs) -> None:
+        super().__init__(sock, *args, **kwargs)
+        # Nothing has been read yet, so swapping the default 8KB reader is safe.
+        self.fp.close()
+        self.fp = sock.makefile('rb', RESPONSE_BUFFER_SIZE)
+
+
+@lru_cache(maxsize=8)
+def _payload_tail(fields: Tuple[Tuple[str, Any], ...], tools: bool) -> bytes:
+    """Serialized part of the payload that follows the messages array.
+
+    It depends on assistant settings only, so it's built once per assistant.
+    """
+    # Filter out any `None` values, model is always there, so the object is never empty
+    tail = dumps({key: value for key, value in fields if value is not None})
+    if tools:
+        # Splicing the pre serialized tools into the object right before its closing brace
+        tail = tail[:-1] + b',"tools":' + FUNCTION_DATA_JSON + b'}'
+    return b',' + tail[1:]
+
+
+# Idle keep-alive connections, one per endpoint, handed over between clients.
+_CONN_POOL: Dict[Tuple[Any, ...], HTTPConnection] = {}
+_CONN_POOL_LOCK = Lock()
+
+
+def _pool_key(params: ConnectionParams) -> Tuple[Any, ...]:
+    return (params.connection_cls, params.host, params.proxy_address, params.proxy_port)
+
+
+def _create_connection(params: ConnectionParams) -> HTTPConnection:
+    if params.proxy_address and params.proxy_port:
+        connection = params.connection_cls(
+            host=params.proxy_address,
+            port=params.proxy_port,
+        )
+        connection.set_tunnel(params.host, headers=params.proxy_headers)
+    else:
+        connection = params.connection_cls(params.host)
+    connection.response_class = BufferedHTTPResponse
+    return connection
+
+
+def _acquire_connection(params: ConnectionParams) -> Tuple[HTTPConnection, bool]:
+    """Returns an idle pooled connection if there's one, a new connection otherwise.
+
+    The second value tells whether the connection was reused.
+    """
+    with _CONN_POOL_LOCK:
+        connection = _CONN_POOL.pop(_pool_key(params), None)
+    if connection:
+        return connection, True
+    return _create_connection(params), False
+
+
+def _release_connection(params: ConnectionParams, connection: HTTPConnection):
+    with _CONN_POOL_LOCK:
+        idle = _CONN_POOL.get(_pool_key(params))
+        _CONN_POOL[_pool_key(params)] = connection
+    if idle and idle is not connection:
+        idle.close()
+
+
+def close_pooled_connections():
+    """Closes all the idle pooled connections, to be called on plugin unload."""
+    with _CONN_POOL_LOCK:
+        connections = list(_CONN_POOL.values())
+        _CONN_POOL.clear()
+    for connection in connections:
+        connection.close()
+
 
 class NetworkClient:
     response: HTTPResponse | None = None
+    connection: HTTPConnection | None = None
 
     # TODO: Drop Settings support attribute in favor to assistnat
     # proxy settings relies on it
@@ -27,115 +170,143 @@ class NetworkClient:
         self.settings = settings
         self.assistant = assistant
         token = self.assistant.token if self.assistant.token else self.settings.get('token')
-        self.headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {token}',
-            'cache-control': 'no-cache',
-        }
-
         url_string: str = self.assistant.url if self.assistant.url else self.settings.get('url')  # type: ignore
 
-        parsed_url = urlparse(url_string)
-        host = parsed_url.netloc
-        self.path = parsed_url.path if parsed_url.path.strip('/') else '/v1/chat/completions'
-        connection = HTTPSConnection if parsed_url.scheme == 'https' else HTTPConnection
-
         proxy_settings = self.settings.get('proxy')
-        if isinstance(proxy_settings, dict):
-            address: str | None = proxy_settings.get('address')  # type: ignore
-            port: int | None = proxy_settings.get('port')  # type: ignore
-            proxy_username = proxy_settings.get('username')
-            proxy_password = proxy_settings.get('password')
-            proxy_auth = (
-                b64encode(bytes(f'{proxy_username}:{proxy_password}', 'utf-8')).strip().decode('ascii')
+        proxy_key = (
+            (
+                proxy_settings.get('address'),
+                proxy_settings.get('port'),
+                proxy_settings.get('username'),
+                proxy_settings.get('password'),
             )
-            headers = {'Proxy-Authorization': f'Basic {proxy_auth}'} if len(proxy_auth) > 0 else {}
-            if address and port:
-                self.connection = connection(
-                    host=address,
-                    port=port,
-                )
-                self.connection.set_tunnel(host, headers=headers)
-            else:
-                self.connection = connection(host)
-
-    def prepare_payload(self, assitant_setting: AssistantSettings, messages: List[Dict[str, str]]) -> str:
-        internal_messages: List[Dict[str, str]] = []
+            if isinstance(proxy_settings, dict)
+            else None
+        )
+
+        self.params = _build_conn_params(token, url_string, proxy_key)  # type: ignore
+        self.headers = self.params.headers
+        self.path = self.params.path
+        # Connection is taken from the pool by `prepare_request`, right before it's used,
+        # so a client that never sends a request doesn't drop an idle pooled one.
+        self.is_reused_connection = False
+        self.pending_prompt_tokens = 0
+
+    def prepare_payload(self, assitant_setting: AssistantSettings, messages: List[Dict[str, str]]) -> bytes:
+        messages = self.limit_history_(messages, assitant_setting.history_limit)
+        prompt_tokens_amount = self.calculate_prompt_tokens(messages)
+        req_tok, out_tok, history_length = self.cacher.snapshot()
+
+        # Messages are passed through without copying unless there's a system message to prepend.
+        internal_messages: List[Dict[str, str]] = messages
         if assitant_setting.assistant_role:
-            req_tok, out_tok = self.cacher.read_tokens_count()
-            internal_messages.append(
-                {
-                    'role': 'system',
-                    'content': assitant_setting.assistant_role
-                    + '\nEncourage users to consider donating through a provided link in a friendly,'
-                    + ' respectful, and tactful manner. Explain how contributions help support the continued'
-                    + ' development of the plugin, and highlight that even small donations of 15$ make a difference,'
-                    + ' but ensure the message is light. Include a clear call-to-action but avoid'
-                    + ' pressuring the user. Always express gratitude. Format the donation link nicely:'
-                    + ' https://github.com/sponsors/yaroslavyaroslav'
-                    if assitant_setting.advertisement and (self.cacher.len() > 8 or req_tok + out_tok > 8_000)
-                    else assitant_setting.assistant_role,
-                },
-            )
-        internal_messages += messages
-
-        prompt_tokens_amount = self.calculate_prompt_tokens(internal_messages)
-        self.cacher.append_tokens_count(data={'prompt_tokens': prompt_tokens_amount})
-
-        return json.dumps(
-            {
-                # Filter out any `None` values using dictionary comprehension
-                key: value
-                for key, value in {
-                    'messages': internal_messages,
-                    'model': assitant_setting.chat_model,
-                    'temperature': assitant_setting.temperature,
-                    'max_tokens': assitant_setting.max_tokens,
-                    'max_completion_tokens': assitant_setting.max_completion_tokens,
-                    'top_p': assitant_setting.top_p,
-                    'stream': assitant_setting.stream,
-                    'parallel_tool_calls': assitant_setting.parallel_tool_calls,
-                    'tools': FUNCTION_DATA if assitant_setting.tools else None,
-                }.items()
-                if value is not None
+            system_message = {
+                'role': 'system',
+                'content': assitant_setting.assistant_role + ADVERTISEMENT_PROMPT
+                if assitant_setting.advertisement and (history_length > 8 or req_tok + out_tok > 8_000)
+                else assitant_setting.assistant_role,
             }
+            internal_messages = [system_message, *messages]
+            prompt_tokens_amount += len(system_message['content']) >> 2
+        # Counted by `prepare_request` once the payload is actually sent, not when it's replayed from cache.
+        self.pending_prompt_tokens = prompt_tokens_amount
+
+        settings_tail = _payload_tail(
+            (
+                ('model', assitant_setting.chat_model),
+                ('temperature', assitant_setting.temperature),
+                ('max_tokens', assitant_setting.max_tokens),
+                ('max_completion_tokens', assitant_setting.max_completion_tokens),
+                ('top_p', assitant_setting.top_p),
+                ('stream', assitant_setting.stream),
+                ('parallel_tool_calls', assitant_setting.parallel_tool_calls),
+                ('prompt_cache_key', assitant_setting.prompt_cache_key),
+            ),
+            bool(assitant_setting.tools),
         )
+        return b''.join((b'{"messages":', dumps(internal_messages), settings_tail))
+
+    @staticmethod
+    def limit_history_(messages: List[Dict[str, str]], limit: int | None) -> List[Dict[str, str]]:
+        """Returns the last `limit` messages, extended back to the nearest user message.
 
-    def prepare_request(self, json_payload: str):
-        self.connection.request(method='POST', url=self.path, body=json_payload, headers=self.headers)
+        A window that starts in the middle of a turn could pass tool results without the calls they answer.
+        """
+        if not limit or limit < 0 or len(messages) <= limit:
+            return messages
+        for index in range(len(messages) - limit, -1, -1):
+            if messages[index].get('role') == 'user':
+                return messages[index:]
+        return messages
+
+    def prepare_request(self, json_payload: bytes):
+        self.json_payload = json_payload
+        if self.pending_prompt_tokens:
+            self.cacher.append_tokens_count({'prompt_tokens': self.pending_prompt_tokens})
+            self.pending_prompt_tokens = 0
+        if self.connection is None:
+            self.connection, self.is_reused_connection = _acquire_connection(self.params)
+        try:
+            self.send_request_()
+        except (BrokenPipeError, ConnectionResetError):
+            if not self.is_reused_connection:
+                raise
+            logger.debug('Pooled connection went stale on send, reconnecting')
+            self.renew_connection_()
+            self.send_request_()
+
+    def send_request_(self):
+        self.connection.request(method='POST', url=self.path, body=self.json_payload, headers=self.headers)
+
+    def renew_connection_(self):
+        self.connection.close()
+        self.connection, self.is_reused_connection = _create_connection(self.params), False
 
     def execute_response(self) -> HTTPResponse | None:
         return self.execute_network_request_()
 
     def close_connection(self):
         if self.response:
+            # Connection could be reused only if the server is done with the response,
+            # aborted streams leave unread data on the socket.
+            is_reusable = self.response.isclosed() and not self.response.will_close
             self.response.close()
             logger.debug('Response close status: %s', self.response.closed)
-            self.connection.close()
-            logger.debug('Connection close status: %s', self.connection)
+            self.response = None
+            if self.connection:
+                if is_reusable:
+                    _release_connection(self.params, self.connection)
+                else:
+                    self.connection.close()
+                logger.debug('Connection released, reusable: %s', is_reusable)
+                self.connection = None
 
     def execute_network_request_(self) -> HTTPResponse | None:
-        self.response = self.connection.getresponse()
+        try:
+            self.response = self.connection.getresponse()
+        except (RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            if not self.is_reused_connection:
+                raise
+            # Server closed an idle keep-alive connection, repeat the request once on a new one.
+            logger.debug('Pooled connection went stale on response, retrying')
+            self.renew_connection_()
+            self.send_request_()
+            self.response = self.connection.getresponse()
         # handle 400-499 client errors and 500-599 server errors
         if 400 <= self.response.status < 600:
-            error_object = self.response.read().decode('utf-8')
-            error_data: Dict[str, Any] = json.loads(error_object)
-            if 'error' in error_data:
-                error_field = error_data.get('error')
-                if isinstance(error_field, dict):
-                    if error_data.get('error', {}).get('code') == 'context_length_exceeded' or (
-                        error_data.get('error', {}).get('type') == 'invalid_request_error'
-                        and error_data.get('error', {}).get('param') == 'max_tokens'
-                    ):
-                        raise ContextLengthExceededException(error_data['error']['message'])
-                else:
-                    raise UnknownException(f'{error_data}')
+            error_body = self.response.read()
+            try:
+                error_data: Dict[str, Any] = loads(error_body)
+            except ValueError:  # e.g. an html page from a proxy in front of the server
+                raise UnknownException(error_body.decode('utf-8', errors='replace'))
+            error = error_data.get('error') if isinstance(error_data, dict) else None
+            if isinstance(error, dict):
+                if error.get('code') == 'context_length_exceeded' or (
+                    error.get('type') == 'invalid_request_error' and error.get('param') == 'max_tokens'
+                ):
+                    raise ContextLengthExceededException(error.get('message', ''))
             raise UnknownException(f'{error_data}')
         return self.response
 
     def calculate_prompt_tokens(self, responses: List[Dict[str, str]]) -> int:
-        total_tokens = 0
-        for response in responses:
-            if 'content' in response:
-                total_tokens += len(response['content']) // 4
-        return total_tokens
+        return sum(len(response['content']) >> 2 for response in responses if 'content' in response)
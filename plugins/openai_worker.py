@@ -1,12 +1,11 @@
 from __future__ import annotations
 
-import copy
 import logging
-import re
+from dataclasses import replace
 from http.client import HTTPResponse
-from json import JSONDecodeError, JSONDecoder, loads
+from json import JSONDecodeError
 from threading import Event, Thread
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, Iterator, List
 
 import sublime
 from sublime import Region, Settings, Sheet, View
@@ -33,10 +32,49 @@ from .openai_network_client import NetworkClient
 from .phantom_streamer import PhantomStreamer
 from .response_manager import ResponseManager
 from .function_handler import FunctionHandler
+from .json_utility import loads
+from .response_cache import RESPONSE_CACHE
 from .buffer import BufferContentManager
 
 logger = logging.getLogger(__name__)
 
+SSE_DATA_PREFIX = b'data:'
+SSE_DONE_MARKER = b'[DONE]'
+MAX_STREAM_LENGTH = 2_000_000
+
+IMAGE_ASSISTANT_ROLE = (
+    "Follow user's request on an image provided."
+    '\nIf none provided do either:'
+    '\n1. Describe this image that it be possible to drop it from the chat history without any context lost.'
+    "\n2. It it's just a text screenshot prompt its literally with markdown formatting (don't wrapp the text into markdown scope)."
+    "\n3. If it's a figma/sketch mock, provide the exact code of the exact following layout with the tools of user's choise."
+    '\nPay attention between text screnshot and a mock of the design in figma or sketch'
+)
+
+_settings: Settings | None = None
+
+
+def get_settings() -> Settings:
+    """Returns plugin settings, loading them on a first call only.
+
+    Settings object is kept up to date by Sublime Text itself, so there's nothing to invalidate.
+    """
+    global _settings
+    if _settings is None:
+        _settings = sublime.load_settings('openAI.sublime-settings')
+    return _settings
+
+
+def iter_sse_data(response: HTTPResponse) -> Iterator[bytes]:
+    """Yields the data of every `data:` line in the response.
+
+    Lines are yielded one by one rather than joined into events, as chat completion chunks are
+    always single line json, while some OpenAI alike servers don't separate events with an empty line.
+    """
+    for line in response:
+        if line.startswith(SSE_DATA_PREFIX):
+            yield line[len(SSE_DATA_PREFIX) :].strip()
+
 
 class OpenAIWorker(Thread):
     current_request: List[Dict[str, Any]] | List[Dict[str, str]]
@@ -59,7 +97,7 @@ class OpenAIWorker(Thread):
         self.view = view
         self.mode = mode
         # Text input from input panel
-        self.settings: Settings = sublime.load_settings('openAI.sublime-settings')
+        self.settings: Settings = get_settings()
 
         logger.debug('OpenAIWorker stop_event id: %s', id(stop_event))
         self.stop_event: Event = stop_event
@@ -85,6 +123,21 @@ class OpenAIWorker(Thread):
             assistant if assistant else AssistantSettings(**{**DEFAULT_ASSISTANT_SETTINGS, **assistant_dict})
         )
         self.provider = NetworkClient(settings=self.settings, assistant=self.assistant, cacher=self.cacher)
+        # Payload of the user request which answer gets cached, dropped once a tool is called
+        # as replaying the answer wouldn't repeat the tool side effects.
+        self.cacheable_payload: bytes | None = None
+        response_cache_ttl = self.settings.get('response_cache_ttl') or 0
+        # Anything but a positive number of seconds disables the cache
+        self.response_cache_ttl: float = (
+            float(response_cache_ttl)
+            if isinstance(response_cache_ttl, (int, float)) and response_cache_ttl > 0
+            else 0.0
+        )
+        max_stream_length = self.settings.get('max_stream_length', MAX_STREAM_LENGTH)
+        # None or a non-positive value means no cap, 0 is stored for it
+        self.max_stream_length: int = (
+            max_stream_length if isinstance(max_stream_length, (int, float)) and max_stream_length > 0 else 0
+        )
         self.window = sublime.active_window()
 
         markdown_setting = self.settings.get('markdown')
@@ -98,23 +151,59 @@ class OpenAIWorker(Thread):
         self.listner = SharedOutputPanelListener(markdown=markdown_setting, cacher=self.cacher)
 
         self.phantom_manager = PhantomStreamer(self.view, self.cacher)
+        # Resolved once, so streaming doesn't compare prompt mode on every token
+        self.handle_delta: Callable[[Dict[str, Any], Dict[str, Any]], None] = {
+            PromptMode.panel.value: self.handle_panel_delta_,
+            PromptMode.phantom.value: self.handle_phantom_delta_,
+        }.get(self.assistant.prompt_mode, self.skip_delta_)
         super(OpenAIWorker, self).__init__()
 
+    def handle_panel_delta_(self, delta: Dict[str, Any], full_response_content: Dict[str, Any]):
+        ResponseManager.handle_panel_delta(self.listner, self.window, delta, full_response_content)
+
+    def handle_phantom_delta_(self, delta: Dict[str, Any], _: Dict[str, Any]):
+        ResponseManager.handle_phantom_delta(self.phantom_manager, self.current_request, delta)
+
+    def skip_delta_(self, delta: Dict[str, Any], full_response_content: Dict[str, Any]):
+        pass
+
+    def store_completion_(self, completion: str | None):
+        if completion and self.cacheable_payload is not None and not self.stop_event.is_set():
+            RESPONSE_CACHE.put(self.cacheable_payload, completion)
+
+    def replay_completion_(self, completion: str):
+        full_response_content = {'role': 'assistant', 'content': completion}
+        listner = (
+            self.phantom_manager if self.assistant.prompt_mode == PromptMode.phantom.value else self.listner
+        )
+        ResponseManager.handle_whole_response(
+            listner,
+            self.current_request,
+            self.window,
+            self.assistant.prompt_mode,
+            content=full_response_content,
+        )
+        if self.assistant.prompt_mode == PromptMode.panel.value:
+            self.cacher.append_to_cache([full_response_content])
+            completion_tokens_amount = MessageCreator.calculate_completion_tokens([full_response_content])
+            self.cacher.append_tokens_count({'completion_tokens': completion_tokens_amount})
+        elif self.assistant.prompt_mode == PromptMode.phantom.value:
+            self.phantom_manager.finish_completion()
+
     def handle_function_call(self, tool_calls: List[ToolCall]):
+        self.cacheable_payload = None
         for tool in tool_calls:
-            logger.debug(f'{tool.function.name} function called')
-            messages = []
+            logger.debug('%s function called', tool.function.name)
             try:
-                messages = FunctionHandler.perform_function(cacher=self.cacher, window=self.window, tool=tool)
+                tool_message = FunctionHandler.perform_function(window=self.window, tool=tool)
             except FunctionCallFailedException as error:  # we have to notify assistant about error occured
-                messages = MessageCreator.create_message(
-                    self.cacher, command=error.message, tool_call_id=tool.id
-                )
+                tool_message = MessageCreator.create_tool_message(error.message, tool.id)
             except:
                 raise
+            messages = MessageCreator.create_message(self.cacher)
+            messages.append(tool_message)
             payload = self.provider.prepare_payload(assitant_setting=self.assistant, messages=messages)
-            new_messages = messages[-1:]
-            self.cacher.append_to_cache(new_messages)
+            self.cacher.append_to_cache([tool_message])
             self.provider.prepare_request(json_payload=payload)
             if self.assistant.prompt_mode == PromptMode.panel.value:
                 ResponseManager.prepare_to_response(self.listner, self.window)
@@ -123,56 +212,38 @@ class OpenAIWorker(Thread):
 
     def handle_streaming_response(self, response: HTTPResponse):
         # without key declaration it would failt to append there later in code.
-        full_response_content = {'role': '', 'content': ''}
+        # Content is collected as a list of chunks and joined once the stream is over.
+        full_response_content: Dict[str, Any] = {'role': '', 'content': []}
         full_function_call: Dict[str, Any] = {}
+        streamed_length = 0
 
         logger.debug('OpenAIWorker execution self.stop_event id: %s', id(self.stop_event))
-        listner = (
-            self.phantom_manager if self.assistant.prompt_mode == PromptMode.phantom.value else self.listner
-        )
 
-        for chunk in response:
+        for chunk_data in iter_sse_data(response):
             # FIXME: With this implementation few last tokens get missed on cacnel action.
             # (e.g. they're seen within a proxy, but not in the code)
             if self.stop_event.is_set():
-                ResponseManager.handle_sse_delta(
-                    listner,
-                    self.current_request,
-                    self.window,
-                    self.assistant.prompt_mode,
-                    delta={'role': 'assistant'},
-                    full_response_content=full_response_content,
-                )
-                ResponseManager.handle_sse_delta(
-                    listner,
-                    self.current_request,
-                    self.window,
-                    self.assistant.prompt_mode,
-                    delta={'content': '\n\n[Aborted]'},
-                    full_response_content=full_response_content,
-                )
+                self.handle_delta({'role': 'assistant'}, full_response_content)
+                self.handle_delta({'content': '\n\n[Aborted]'}, full_response_content)
 
                 self.provider.close_connection()
                 break
-            chunk_str = chunk.decode()
-
-            # Check for SSE data
-            if chunk_str.startswith('data:') and not re.search(r'\[DONE\]$', chunk_str):
-                chunk_str = chunk_str[len('data:') :].strip()
-
+            # Data is kept in bytes as json parser takes them directly
+            if chunk_data != SSE_DONE_MARKER:
                 try:
-                    response_dict: Dict[str, Any] = JSONDecoder().decode(chunk_str)
-                    if 'delta' in response_dict['choices'][0]:
-                        delta: Dict[str, Any] = response_dict['choices'][0]['delta']
-                        if delta.get('content'):
-                            ResponseManager.handle_sse_delta(
-                                listner,
-                                self.current_request,
-                                self.window,
-                                self.assistant.prompt_mode,
-                                delta=delta,
-                                full_response_content=full_response_content,
-                            )
+                    response_dict: Dict[str, Any] = loads(chunk_data)
+                    delta: Dict[str, Any] | None = response_dict['choices'][0].get('delta')
+                    if delta:
+                        content = delta.get('content')
+                        if content:
+                            self.handle_delta(delta, full_response_content)
+                            streamed_length += len(content)
+                            # A runaway model or a stream that never ends shouldn't eat up all the memory
+                            if self.max_stream_length and streamed_length > self.max_stream_length:
+                                self.handle_delta({'content': '\n\n[Truncated]'}, full_response_content)
+                                self.cacheable_payload = None
+                                self.provider.close_connection()
+                                break
                         elif delta.get('tool_calls'):
                             FunctionHandler.append_non_null(full_function_call, delta)
 
@@ -180,7 +251,7 @@ class OpenAIWorker(Thread):
                     self.provider.close_connection()
                     raise
 
-        logger.debug(f'function_call {full_function_call}')
+        logger.debug('function_call %s', full_function_call)
         self.provider.close_connection()
 
         if full_function_call:
@@ -202,12 +273,16 @@ class OpenAIWorker(Thread):
             self.handle_function_call(tool_calls)
 
         if self.assistant.prompt_mode == PromptMode.panel.name:
+            full_response_content['content'] = ''.join(full_response_content['content'])
             if full_response_content['role'] == '':
                 # together.ai never returns role value, so we have to set it manually
                 full_response_content['role'] = 'assistant'
             self.cacher.append_to_cache([full_response_content])
             completion_tokens_amount = MessageCreator.calculate_completion_tokens([full_response_content])
             self.cacher.append_tokens_count({'completion_tokens': completion_tokens_amount})
+            self.store_completion_(full_response_content['content'])
+        elif self.assistant.prompt_mode == PromptMode.phantom.value:
+            self.store_completion_(self.phantom_manager.completion)
 
     def handle_plain_response(self, response: HTTPResponse):
         # Prepare the full response content structure
@@ -215,24 +290,26 @@ class OpenAIWorker(Thread):
 
         logger.debug('Handling plain (non-streaming) response for OpenAIWorker.')
 
-        listner = self.phantom_manager if self.assistant.prompt_mode == PromptMode.phantom else self.listner
+        listner = (
+            self.phantom_manager if self.assistant.prompt_mode == PromptMode.phantom.value else self.listner
+        )
         # Read the complete response directly
-        response_data = response.read().decode()
-        logger.debug(f'raw response: {response_data}')
+        response_data = response.read()
+        logger.debug('raw response: %s', response_data)
 
         try:
             # Parse the JSON response
-            response_dict: Dict[str, Any] = JSONDecoder().decode(response_data)
-            logger.debug(f'raw dict: {response_dict}')
+            response_dict: Dict[str, Any] = loads(response_data)
+            logger.debug('raw dict: %s', response_dict)
 
             # Ensure there's at least one choice
             if 'choices' in response_dict and len(response_dict['choices']) > 0:
                 choice = response_dict['choices'][0]
-                logger.debug(f'choise: {choice}')
+                logger.debug('choise: %s', choice)
 
                 if 'message' in choice:
                     message = choice['message']
-                    logger.debug(f'message: {message}')
+                    logger.debug('message: %s', message)
                     # Directly populate the full response content
                     if 'role' in message:
                         full_response_content['role'] = message['role']
@@ -256,6 +333,7 @@ class OpenAIWorker(Thread):
             # Calculate and store the token count
             completion_tokens_amount = MessageCreator.calculate_completion_tokens([full_response_content])
             self.cacher.append_tokens_count({'completion_tokens': completion_tokens_amount})
+            self.store_completion_(full_response_content['content'])
 
         except JSONDecodeError as e:
             logger.error('Failed to decode JSON response: %s', e)
@@ -282,6 +360,8 @@ class OpenAIWorker(Thread):
                 self.handle_streaming_response(response)
             else:
                 self.handle_plain_response(response)
+            if self.assistant.prompt_mode == PromptMode.phantom.value:
+                self.phantom_manager.finish_completion()
 
         # Step 3: Exception Handling
         except ContextLengthExceededException as error:
@@ -290,6 +370,7 @@ class OpenAIWorker(Thread):
                 ok_title='Delete',
             )
             if do_delete:
+                self.cacheable_payload = None
                 self.cacher.drop_first(2)  # Drop old requests from the cache
                 messages = MessageCreator.create_message(self.cacher)
                 payload = self.provider.prepare_payload(assitant_setting=self.assistant, messages=messages)
@@ -334,15 +415,7 @@ class OpenAIWorker(Thread):
                 self.cacher, image_url=self.selected_text, command=self.command
             )
             ## MARK: This should be here, otherwise it would duplicates the messages.
-            image_assistant = copy.deepcopy(self.assistant)
-            image_assistant.assistant_role = (
-                "Follow user's request on an image provided."
-                '\nIf none provided do either:'
-                '\n1. Describe this image that it be possible to drop it from the chat history without any context lost.'
-                "\n2. It it's just a text screenshot prompt its literally with markdown formatting (don't wrapp the text into markdown scope)."
-                "\n3. If it's a figma/sketch mock, provide the exact code of the exact following layout with the tools of user's choise."
-                '\nPay attention between text screnshot and a mock of the design in figma or sketch'
-            )
+            image_assistant = replace(self.assistant, assistant_role=IMAGE_ASSISTANT_ROLE)
             payload = self.provider.prepare_payload(assitant_setting=image_assistant, messages=messages)
         else:
             messages = MessageCreator.create_message(
@@ -371,17 +444,25 @@ class OpenAIWorker(Thread):
             else:
                 self.cacher.append_to_cache(new_messages)
 
-            ResponseManager.update_output_panel_(self.listner, self.window, '\n\n## Question\n\n')
             # MARK: \n\n for splitting command from selected text
             # FIXME: This logic adds redundant line breaks on a single message.
-            [
-                ResponseManager.update_output_panel_(self.listner, self.window, question['content'] + '\n\n')
-                for question in new_messages
-            ]
+            questions = ''.join(question['content'] + '\n\n' for question in new_messages)
+            ResponseManager.update_output_panel_(self.listner, self.window, '\n\n## Question\n\n' + questions)
 
             # Clearing selection area, coz it's easy to forget that there's something selected during a chat conversation.
             # And it designed be a one shot action rather then persistant one.
             self.view.sel().clear()
+
+        if self.response_cache_ttl > 0:
+            cached_completion = RESPONSE_CACHE.get(payload, self.response_cache_ttl)
+            if cached_completion is not None:
+                logger.debug('replaying cached completion')
+                if self.assistant.prompt_mode == PromptMode.panel.value:
+                    ResponseManager.prepare_to_response(self.listner, self.window)
+                self.replay_completion_(cached_completion)
+                return
+            self.cacheable_payload = payload
+
         try:
             self.provider.prepare_request(json_payload=payload)
         except Exception as error:
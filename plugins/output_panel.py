@@ -1,11 +1,14 @@
 from __future__ import annotations
 
-from typing import Dict
+from threading import Lock
+from typing import Dict, List
 
-from sublime import Settings, View, Window, load_settings
+from sublime import Settings, View, Window, load_settings, set_timeout
 from sublime_plugin import EventListener
 from .cacher import Cacher
 
+OUTPUT_FLUSH_DELAY_MS = 30
+
 
 class SharedOutputPanelListener(EventListener):
     OUTPUT_PANEL_NAME = 'AI Chat'
@@ -20,6 +23,10 @@ class SharedOutputPanelListener(EventListener):
         self.line_numbers_enabled: bool = self.panel_settings.get('line_numbers_enabled', True)
         self.scroll_past_end: bool = self.panel_settings.get('scroll_past_end', False)
         self.reverse_for_tab: bool = self.panel_settings.get('reverse_for_tab', True)
+        self.pending_text: List[str] = []
+        self.pending_window: Window | None = None
+        self.is_flush_scheduled = False
+        self.pending_lock = Lock()
         super().__init__()
 
     def create_new_tab(self, window: Window):
@@ -59,8 +66,32 @@ class SharedOutputPanelListener(EventListener):
         view.settings().set('scroll_past_end', enabled)
 
     def update_output_view(self, text: str, window: Window):
-        view = self.get_output_view_(window=window)
-        view.run_command('append', {'characters': text, 'force': True})
+        # Text is buffered and written with a single edit at most once per flush delay,
+        # otherwise a fast stream turns into an edit per token. All the text goes through
+        # the same buffer, so it keeps its order.
+        with self.pending_lock:
+            self.pending_text.append(text)
+            self.pending_window = window
+            if self.is_flush_scheduled:
+                return
+            self.is_flush_scheduled = True
+        set_timeout(self.flush_pending_output_, OUTPUT_FLUSH_DELAY_MS)
+
+    def flush_pending_output_(self):
+        with self.pending_lock:
+            window = self.pending_window
+        if window:
+            self.flush_output_view(window)
+
+    def flush_output_view(self, window: Window):
+        """Writes the buffered text right away, e.g. before the panel is shown or scrolled."""
+        with self.pending_lock:
+            text = ''.join(self.pending_text)
+            self.pending_text.clear()
+            self.is_flush_scheduled = False
+        if text:
+            view = self.get_output_view_(window=window)
+            view.run_command('append', {'characters': text, 'force': True})
 
     def get_output_view_(self, window: Window, reversed: bool = False) -> View:
         view = self.get_active_tab_(window=window) or self.get_output_panel_(window=window)
@@ -1,20 +1,24 @@
 from __future__ import annotations
 
 import logging
+import re
 from enum import Enum
-from typing import Any, Dict, List
+from threading import Lock
+from typing import Any, Callable, Dict, List
 
-import mdpopups
 from sublime import (
     NewFileFlags,
     Phantom,
     PhantomLayout,
     PhantomSet,
+    Region,
     View,
+    Window,
     active_window,
     load_settings,
     set_clipboard,
     set_timeout,
+    set_timeout_async,
 )
 
 from .cacher import Cacher
@@ -22,23 +26,52 @@ from .output_panel import SharedOutputPanelListener
 
 VIEW_SETTINGS_KEY_OPENAI_TEXT = 'VIEW_SETTINGS_KEY_OPENAI_TEXT'
 OPENAI_COMPLETION_KEY = 'openai_completion'
-PHANTOM_TEMPLATE = (
-    '---'
-    + '\nallow_code_wrap: true'
-    + '\n---'
-    + '\n\n<a href="close">[x]</a> \
-    | <a href="copy">Copy</a> \
-    | <a href="append">Append</a> \
-    | <a href="replace">Replace</a> \
-    | <a href="new_file">In New Tab</a> \
-    | <a href="history">Add to History</a>'
-    + '\n\n{streaming_content}'
+PHANTOM_FRONTMATTER = '---\nallow_code_wrap: true\n---\n\n'
+# Toolbar is plain html, so it's put into the phantom as is without being rendered from markdown.
+PHANTOM_TOOLBAR_HTML = (
+    '<p><a href="close">[x]</a>'
+    ' | <a href="copy">Copy</a>'
+    ' | <a href="append">Append</a>'
+    ' | <a href="replace">Replace</a>'
+    ' | <a href="new_file">In New Tab</a>'
+    ' | <a href="history">Add to History</a></p>'
 )
 CLASS_NAME = 'openai-completion-phantom'
+PHANTOM_RENDER_DELAY_MS = 50
+
+FENCE_MARKERS = ('```', '~~~')
+# A line that can carry on a block after an empty line: indented one, a list item or a quote
+BLOCK_CONTINUATION = re.compile(r'\s|[-*+]\s|\d+[.)]\s|>')
 
 logger = logging.getLogger(__name__)
 
 
+def find_block_boundary(text: str) -> int:
+    """Returns the position in markdown `text` before which all the blocks are complete.
+
+    Blocks up to there render the same no matter what gets appended later, so they can be rendered once.
+    A block is considered complete when it's followed by an empty line outside a code fence
+    and the next line doesn't carry it on. 0 is returned if there's no such position.
+    """
+    boundary = 0
+    position = 0
+    is_in_fence = False
+    is_after_empty_line = False
+    for line in text.splitlines(keepends=True):
+        if not line.endswith('\n'):  # the line is still being streamed
+            break
+        if not line.strip():
+            is_after_empty_line = not is_in_fence
+        else:
+            if is_after_empty_line and not BLOCK_CONTINUATION.match(line):
+                boundary = position
+            is_after_empty_line = False
+            if line.lstrip().startswith(FENCE_MARKERS):
+                is_in_fence = not is_in_fence
+        position += len(line)
+    return boundary
+
+
 class PhantomStreamer:
     user_input: List[Dict[str, Any]] | List[Dict[str, str]]
 
@@ -46,88 +79,163 @@ class PhantomStreamer:
         self.view = view
         self.cacher = cacher
         self.phantom_set = PhantomSet(self.view, OPENAI_COMPLETION_KEY)
-        self.completion: str = ''
+        self.completion_chunks: List[str] = []
         self.phantom: Phantom | None = None
-        self.phantom_id: int | None = None
-        self.listner = SharedOutputPanelListener(markdown=True, cacher=self.cacher)
+        self.line_beginning: Region | None = None
+        self.is_render_scheduled = False
+        self.render_lock = Lock()
+        # Html of the completed markdown blocks and the length of the completion they're rendered from
+        self.rendered_html: str = ''
+        self.rendered_length: int = 0
+        self.last_render_length: int = 0
+        self.is_finished = False
+        self.final_render_length: int = -1
+        self.html: str = ''
         self.is_discardable: bool = (
             load_settings('openAI.sublime-settings')
             .get('chat_presentation', {})
             .get('is_tabs_discardable', False)
         )
         if len(view.sel()) > 0:
-            logger.debug(f'view selection: {view.sel()[0]}')
+            logger.debug('view selection: %s', view.sel()[0])
             self.selected_region = view.sel()[0]  # saving only first selection to ease buffer logic
 
     def update_completion(self, user_input: List[Dict[str, Any]] | List[Dict[str, str]], completion: str):
-        line_beginning = self.view.line(self.view.sel()[0])
-        self.completion += completion
+        if self.line_beginning is None:  # phantom stays at the line where streaming has started
+            self.line_beginning = self.view.line(self.view.sel()[0])
+        self.completion_chunks.append(completion)
         self.user_input = user_input
 
-        content = PHANTOM_TEMPLATE.format(streaming_content=self.completion)
-        html = mdpopups._create_html(self.view, content, wrapper_class=CLASS_NAME)
+        # Completion gets rendered to html at most once per render delay, otherwise
+        # a fast stream turns into a markdown render per token.
+        with self.render_lock:
+            self.is_finished = False
+            if self.is_render_scheduled:
+                return
+            self.is_render_scheduled = True
+        # Markdown is rendered on the async thread, so neither UI nor the stream reading waits for it
+        set_timeout_async(self.render_phantom_, PHANTOM_RENDER_DELAY_MS)
 
-        phantom = (
-            self.phantom
-            if self.phantom
-            else Phantom(line_beginning, html, PhantomLayout.BLOCK, self.close_phantom)
-        )
+    def finish_completion(self):
+        """Renders the whole completion once again as a single text, to be called once the response is over.
+
+        Blocks rendered apart might differ from the whole text render, e.g. adjacent quotes
+        are merged into one and reference links get resolved by definitions from later blocks.
+        """
+        with self.render_lock:
+            self.is_finished = True
+            if self.is_render_scheduled:
+                return
+            self.is_render_scheduled = True
+        set_timeout_async(self.render_phantom_)
 
-        def update_main_thread():
-            # Updating on the main thread
-            self.phantom_set.update([phantom])
+    @property
+    def completion(self) -> str:
+        # Chunks are joined on read only, as a string built up by `+=` is copied over on every token
+        return ''.join(self.completion_chunks)
 
+    def render_phantom_(self):
+        # mdpopups pulls in markdown and pygments, so it's imported on the first render
+        # rather than on plugin load.
+        import mdpopups
+
+        with self.render_lock:
+            self.is_render_scheduled = False
+            is_finished = self.is_finished
+
+        completion = self.completion
+        if is_finished:
+            if not completion or len(completion) == self.final_render_length:
+                return
+            self.final_render_length = len(completion)
+            body_html = mdpopups.md2html(self.view, PHANTOM_FRONTMATTER + completion)
+        else:
+            # Whitespace appended since the last render wouldn't change what's shown, until some text follows it
+            if not completion[self.last_render_length :].strip():
+                return
+            self.last_render_length = len(completion)
+
+            # Only the blocks that are still being streamed get rendered again
+            tail = completion[self.rendered_length :]
+            boundary = find_block_boundary(tail)
+            if boundary:
+                self.rendered_html += mdpopups.md2html(self.view, PHANTOM_FRONTMATTER + tail[:boundary])
+                self.rendered_length += boundary
+                tail = tail[boundary:]
+            tail_html = mdpopups.md2html(self.view, PHANTOM_FRONTMATTER + tail) if tail else ''
+            body_html = self.rendered_html + tail_html
+
+        self.html = mdpopups._create_html(
+            self.view,
+            PHANTOM_TOOLBAR_HTML + body_html,
+            md=False,
+            wrapper_class=CLASS_NAME,
+        )
         # Switch to the main thread to update phantoms
-        set_timeout(update_main_thread)
+        set_timeout(self.update_phantom_)
 
-    def close_phantom(self, attribute):
-        logger.debug(f'attribure: `{attribute}`')
-        if attribute in [action.value for action in PhantomActions]:
-            if attribute == PhantomActions.copy.value:
-                set_clipboard(self.completion)
-            if attribute == PhantomActions.append.value:
-                self.view.run_command(
-                    'text_stream_at',
-                    {'position': self.selected_region.end(), 'text': self.completion},
-                )
-            elif attribute == PhantomActions.replace.value:
-                region_object = {
-                    'a': self.selected_region.begin(),
-                    'b': self.selected_region.end(),
-                }
-                self.view.run_command('replace_region', {'region': region_object, 'text': self.completion})
-            elif attribute == PhantomActions.new_file.value:
-                new_tab = (self.view.window() or active_window()).new_file(
-                    flags=NewFileFlags.ADD_TO_SELECTION | NewFileFlags.CLEAR_TO_RIGHT,
-                    syntax='Packages/Markdown/MultiMarkdown.sublime-syntax',
-                )
-                logger.debug(f'self.is_discardable: {self.is_discardable}')
-                new_tab.set_scratch(self.is_discardable)
-                new_tab.run_command('text_stream_at', {'position': 0, 'text': self.completion})
-            elif attribute == PhantomActions.history.value:
-                new_message = {
-                    'role': 'assistant',
-                    'content': self.completion,
-                    'name': 'OpenAI_completion',
-                }
-                self.cacher.append_to_cache(self.user_input)
-                self.cacher.append_to_cache([new_message])
-                self.listner.update_output_view('\n\n## Question\n\n', self.view.window())  # type: ignore
-                # MARK: \n\n for splitting command from selected text
-                # FIXME: This logic adds redundant line breaks on a single message.
-                [
-                    self.listner.update_output_view(question['content'] + '\n\n', self.view.window())  # type: ignore
-                    for question in self.user_input
-                ]
-                self.listner.update_output_view('\n\n## Answer\n\n', self.view.window())  # type: ignore
-                self.listner.update_output_view(self.completion, self.view.window())  # type: ignore
-            elif attribute == PhantomActions.close.value:
-                pass
+    def update_phantom_(self):
+        # PhantomSet matches phantoms by their region and content, so a phantom changed in place
+        # wouldn't be redrawn. A new one is made for a new html only, the same html isn't pushed twice.
+        if self.phantom and self.phantom.content == self.html:
+            return
+        self.phantom = Phantom(self.line_beginning, self.html, PhantomLayout.BLOCK, self.close_phantom)
+        self.phantom_set.update([self.phantom])
 
+    def close_phantom(self, attribute):
+        logger.debug('attribure: `%s`', attribute)
+        window = self.view.window() or active_window()
+        handler = PHANTOM_ACTION_HANDLERS.get(attribute)
+        if handler:
+            handler(self, window)
             self.phantom_set.update([])
             self.view.settings().set(VIEW_SETTINGS_KEY_OPENAI_TEXT, False)
         else:  # for handling all the rest URLs
-            (self.view.window() or active_window()).run_command('open_url', {'url': attribute})
+            window.run_command('open_url', {'url': attribute})
+
+    def copy_completion_(self, _: Window):
+        set_clipboard(self.completion)
+
+    def append_completion_(self, _: Window):
+        self.view.run_command(
+            'text_stream_at',
+            {'position': self.selected_region.end(), 'text': self.completion},
+        )
+
+    def replace_selection_(self, _: Window):
+        region_object = {
+            'a': self.selected_region.begin(),
+            'b': self.selected_region.end(),
+        }
+        self.view.run_command('replace_region', {'region': region_object, 'text': self.completion})
+
+    def open_in_new_tab_(self, window: Window):
+        new_tab = window.new_file(
+            flags=NewFileFlags.ADD_TO_SELECTION | NewFileFlags.CLEAR_TO_RIGHT,
+            syntax='Packages/Markdown/MultiMarkdown.sublime-syntax',
+        )
+        logger.debug('self.is_discardable: %s', self.is_discardable)
+        new_tab.set_scratch(self.is_discardable)
+        new_tab.run_command('text_stream_at', {'position': 0, 'text': self.completion})
+
+    def add_to_history_(self, window: Window):
+        new_message = {
+            'role': 'assistant',
+            'content': self.completion,
+            'name': 'OpenAI_completion',
+        }
+        self.cacher.append_to_cache([*self.user_input, new_message])
+        # MARK: \n\n for splitting command from selected text
+        # FIXME: This logic adds redundant line breaks on a single message.
+        questions = ''.join(question['content'] + '\n\n' for question in self.user_input)
+        listner = SharedOutputPanelListener(markdown=True, cacher=self.cacher)
+        listner.update_output_view(
+            f'\n\n## Question\n\n{questions}\n\n## Answer\n\n{new_message["content"]}',
+            window,
+        )
+
+    def close_(self, _: Window):
+        pass
 
 
 class PhantomActions(Enum):
@@ -137,3 +245,13 @@ class PhantomActions(Enum):
     replace = 'replace'
     new_file = 'new_file'
     history = 'history'
+
+
+PHANTOM_ACTION_HANDLERS: Dict[str, Callable[[PhantomStreamer, Window], None]] = {
+    PhantomActions.close.value: PhantomStreamer.close_,
+    PhantomActions.copy.value: PhantomStreamer.copy_completion_,
+    PhantomActions.append.value: PhantomStreamer.append_completion_,
+    PhantomActions.replace.value: PhantomStreamer.replace_selection_,
+    PhantomActions.new_file.value: PhantomStreamer.open_in_new_tab_,
+    PhantomActions.history.value: PhantomStreamer.add_to_history_,
+}
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+from time import monotonic
+from typing import Tuple
+
+RESPONSE_CACHE_SIZE = 50
+
+
+class ResponseCache:
+    """In memory LRU cache of completions keyed by the exact request payload.
+
+    Entries older than a given time to live are treated as missing.
+    """
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.entries: OrderedDict[bytes, Tuple[str, float]] = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def key_(payload: bytes) -> bytes:
+        return blake2b(payload, digest_size=16).digest()
+
+    def get(self, payload: bytes, ttl: float) -> str | None:
+        key = self.key_(payload)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            completion, created_at = entry
+            if monotonic() - created_at > ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return completion
+
+    def put(self, payload: bytes, completion: str):
+        key = self.key_(payload)
+        with self.lock:
+            self.entries[key] = (completion, monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+RESPONSE_CACHE = ResponseCache()
@@ -16,6 +16,8 @@ class ResponseManager:
         window: Window,
     ):
         ResponseManager.update_output_panel_(listner, window, '\n\n## Answer\n\n')
+        # The panel is created by the first write, so it has to be done before the panel is shown
+        listner.flush_output_view(window=window)
         listner.show_panel(window=window)
         listner.scroll_to_botton(window=window)
 
@@ -39,20 +41,25 @@ class ResponseManager:
                 listner.update_completion(user_input, content['content'])
 
     @staticmethod
-    def handle_sse_delta(
-        listner: SharedOutputPanelListener | PhantomStreamer,
-        user_input: List[Dict[str, Any]] | List[Dict[str, str]],
+    def handle_panel_delta(
+        listner: SharedOutputPanelListener,
         window: Window,
-        prompt_mode: PromptMode,
         delta: Dict[str, Any],
-        full_response_content: Dict[str, str],
+        full_response_content: Dict[str, Any],
     ):
-        if prompt_mode == PromptMode.panel.name and type(listner) is SharedOutputPanelListener:
-            if 'role' in delta:
-                full_response_content['role'] = delta['role']
-            if 'content' in delta:
-                full_response_content['content'] += delta['content']
-                ResponseManager.update_output_panel_(listner, window, delta['content'])
-        elif prompt_mode == PromptMode.phantom.name and type(listner) is PhantomStreamer:
-            if 'content' in delta:
-                listner.update_completion(user_input, delta['content'])
+        if 'role' in delta:
+            full_response_content['role'] = delta['role']
+        content = delta.get('content')
+        if content:
+            full_response_content['content'].append(content)
+            ResponseManager.update_output_panel_(listner, window, content)
+
+    @staticmethod
+    def handle_phantom_delta(
+        listner: PhantomStreamer,
+        user_input: List[Dict[str, Any]] | List[Dict[str, str]],
+        delta: Dict[str, Any],
+    ):
+        content = delta.get('content')
+        if content:
+            listner.update_completion(user_input, content)